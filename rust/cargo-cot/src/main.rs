@@ -276,13 +276,28 @@ fn get_python_interpreter(base_dir: &Path) -> PathBuf {
             print_error("Was unable to find the Python interpreter after creating the venv.");
             process::exit(1);
         }
-        burn_run(&interpreter_path, &["-m", "pip", "install", "ndspy", "keystone-engine", "pyyaml"], base_dir);
+        burn_run(&interpreter_path, &["-m", "pip", "install", "ndspy", "keystone-engine", "pyyaml", "pyelftools"], base_dir);
+    } else if !python_has_module(&interpreter_path, "elftools", base_dir) {
+        // Virtualenvs created before pyelftools became a dependency of the patcher
+        print_task("Installing missing Python dependencies...");
+        burn_run(&interpreter_path, &["-m", "pip", "install", "pyelftools"], base_dir);
     }
 
     print_note(format!("Using Python interpreter at: {}", interpreter_path.to_string_lossy()));
     interpreter_path
 }
 
+fn python_has_module(interpreter_path: &Path, module: &str, dir: &Path) -> bool {
+    Command::new(interpreter_path)
+        .args(["-c", &format!("import {}", module)])
+        .current_dir(dir)
+        .stdout(Stdio::null())
+        .stderr(Stdio::null())
+        .status()
+        .map(|exit| exit.success())
+        .unwrap_or(false)
+}
+
 fn burn_run<S: AsRef<OsStr>>(cmd: S, args: &[&str], dir: &Path) {
     let arg_list = args.to_vec().join(" ");
     burn_print("$", format!("{} {}", cmd.as_ref().to_string_lossy(), arg_list), Color::Purple, false, false);
@@ -1,58 +1,121 @@
 #!/usr/bin/env python3
+import os
 import sys
 import glob
-from yaml import load, Loader
+import hashlib
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+from pathlib import Path
+from yaml import load, SafeLoader
+try:
+  from yaml import CSafeLoader as Loader
+except ImportError:
+  Loader = SafeLoader
 
-region = sys.argv[1]
+CACHE_DIR = os.path.join(".cache", "linkerscript")
+# Bump when the format returned by parse_file changes
+CACHE_VERSION = 1
 
-linkerscript_lines = []
-all_symbols = set()
+def get_cache_path(yaml_file_path, region):
+  # One entry per file and region, so a modified file overwrites its previous entry
+  key = f"{yaml_file_path}:{region}"
+  return os.path.join(CACHE_DIR, hashlib.sha256(key.encode()).hexdigest() + ".pkl")
 
-linkerscript_lines.append("/* THIS FILE IS AUTO-GENERATED. DO NOT MODIFY! */")
+def parse_file(yaml_file_path, region):
+  # Returns a list of (file_name, load_address, [(symbol_name, address), ...]) tuples.
+  # The load address is None if the file has none for the region.
+  cache_path = get_cache_path(yaml_file_path, region)
+  stat = os.stat(yaml_file_path)
+  # The cache entry is invalidated whenever the file is modified
+  cache_key = (CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+  try:
+    cached_key, files = pickle.loads(Path(cache_path).read_bytes())
+    if cached_key == cache_key:
+      return files
+  except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+    pass
 
-for yaml_file_path in glob.glob("pmdsky-debug/symbols/*.yml"):
+  files = parse_symbol_def(yaml_file_path, region)
+
+  os.makedirs(CACHE_DIR, exist_ok=True)
+  tmp_cache_path = f"{cache_path}.{os.getpid()}.tmp"
+  Path(tmp_cache_path).write_bytes(pickle.dumps((cache_key, files)))
+  os.replace(tmp_cache_path, cache_path)
+  return files
+
+def parse_symbol_def(yaml_file_path, region):
   with open(yaml_file_path, 'r') as f:
-    linkerscript_lines.append("")
-    linkerscript_lines.append(f"/* --- {yaml_file_path} --- */")
-    yaml_string = f.read()
-    symbol_def = load(yaml_string, Loader)
-    for file_name, contents in symbol_def.items():
-      linkerscript_lines.append("")
-      linkerscript_lines.append(f"/* !file {file_name} */")
-      if 'address' in contents:
-        addresses = contents['address']
-        if region in addresses:
+    symbol_def = load(f, Loader)
+
+  files = []
+  for file_name, contents in symbol_def.items():
+    load_addr = None
+    addresses = contents.get('address')
+    if addresses is not None:
+      load_addr = addresses.get(region)
+
+    functions = contents.get('functions') or ()
+    data = contents.get('data') or ()
+
+    file_symbols = []
+    append_symbol = file_symbols.append
+    for function in chain(functions, data):
+      addr = function['address'].get(region)
+      if addr is None:
+        continue
+
+      if isinstance(addr, list):
+        if len(addr) == 0:
+          continue
+        addr = addr[0]
+
+      append_symbol((function['name'], addr))
+
+    files.append((file_name, load_addr, file_symbols))
+  return files
+
+def main():
+  region = sys.argv[1]
+
+  if Loader is SafeLoader:
+    print("Warning: PyYAML was built without libyaml, falling back to the slower pure-Python loader")
+
+  linkerscript_lines = []
+  all_symbols = set()
+  add_line = linkerscript_lines.append
+  add_symbol = all_symbols.add
+
+  add_line("/* THIS FILE IS AUTO-GENERATED. DO NOT MODIFY! */")
+
+  # Each file is parsed independently, results are merged in the original order
+  yaml_file_paths = glob.glob("pmdsky-debug/symbols/*.yml")
+  with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+    parsed_files = executor.map(parse_file, yaml_file_paths, repeat(region))
+
+    for yaml_file_path, files in zip(yaml_file_paths, parsed_files):
+      add_line(f"\n/* --- {yaml_file_path} --- */")
+      for file_name, load_addr, file_symbols in files:
+        add_line(f"\n/* !file {file_name} */")
+        if load_addr is not None:
           symbol = f"{file_name.upper()}_LOAD_ADDR"
 
           # Overlay load addresses are duplicated, ignore the duplicates
-          if not symbol in all_symbols:
-            addr = addresses[region]
-            linkerscript_lines.append(f"{symbol} = {hex(addr)};")
-            all_symbols.add(symbol)
-
-      symbols = []
-      if 'functions' in contents:
-        symbols.extend(contents['functions'])
-      if 'data' in contents:
-        symbols.extend(contents['data'])
-      
-      for function in symbols:
-        name = function['name']
-        addresses = function['address']
-        if region in addresses:
-          addr = addresses[region]
-
-          if isinstance(addr, list):
-            if len(addr) == 0:
-              continue
-            addr = addr[0]
-
-          if name in all_symbols:
+          prev_count = len(all_symbols)
+          add_symbol(symbol)
+          if len(all_symbols) != prev_count:
+            add_line(f"{symbol} = {load_addr:#x};")
+
+        for name, addr in file_symbols:
+          prev_count = len(all_symbols)
+          add_symbol(name)
+          if len(all_symbols) == prev_count:
             print(f"Warning: Duplicate symbol: '{name}'")
-          linkerscript_lines.append(f"{name} = {hex(addr)};")
-          all_symbols.add(name)
+          add_line(f"{name} = {addr:#x};")
 
-with open(f"symbols/generated_{region}.ld", "w") as f:
-  for line in linkerscript_lines:
-    f.write(line)
+  with open(f"symbols/generated_{region}.ld", "w", buffering=1 << 20) as f:
+    f.write('\n'.join(linkerscript_lines))
     f.write('\n')
+
+if __name__ == "__main__":
+  main()
@@ -2,10 +2,11 @@
 import ndspy.rom
 import ndspy.code
 import sys
-import os
 import re
+import mmap
+from pathlib import Path
 import keystone
-from subprocess import Popen, PIPE
+from elftools.elf.elffile import ELFFile
 import glob
 
 OVERLAY_INDEX = 36
@@ -20,8 +21,6 @@ overlay_bin_path = sys.argv[3]
 overlay_elf_path = sys.argv[4]
 rom_out_path = sys.argv[5]
 
-tool_path = os.path.join(os.environ["DEVKITARM"], "bin")
-
 overlay_symbols_lookup = {} # Key = symbol_name: string, value = offset: int
 rom_symbols_lookup = {}     # Key = symbol_name: string, value = offset_and_overlay_id: Tuple<int, int>
 
@@ -56,37 +55,32 @@ def load_linkerscript_symbols():
             symbol_name, offset_str = match.groups()
             offset = int(offset_str, 16)
 
-            if symbol_name in rom_symbols_lookup:
-              print(f"Warning: Duplicate symbol: '{symbol_name}'")
+            prev_count = len(rom_symbols_lookup)
             rom_symbols_lookup[symbol_name] = (offset, overlay_index)
+            if len(rom_symbols_lookup) == prev_count:
+              print(f"Warning: Duplicate symbol: '{symbol_name}'")
+
+def load_overlay_symbols(overlay_elf):
+  symtab = overlay_elf.get_section_by_name('.symtab')
+  assert symtab, "No symbol table found in the overlay ELF"
 
-def load_overlay_symbols():
-  nm_path = os.path.join(tool_path, "arm-none-eabi-nm")
-  process = Popen([nm_path, overlay_elf_path], stdout=PIPE)
-  (stdout, stderr) = process.communicate()
-  exit_code = process.wait()
-  assert exit_code == 0, f"nm failed with code {exit_code}"
-
-  lines = stdout.decode().split('\n')
-  for line in lines:
-    parts = line.strip().split()
-    
-    if (len(parts) < 3):
+  for symbol in symtab.iter_symbols():
+    # Skip the symbols that nm doesn't list by default (undefined, file, section and ARM mapping symbols)
+    name = symbol.name
+    if not name or name.startswith('$') or symbol['st_shndx'] == 'SHN_UNDEF':
       continue
-            
-    offset = int(parts[0], 16)
-    type = parts[1]
-    name = parts[2]
-    overlay_symbols_lookup[name] = offset
+    if symbol['st_info']['type'] in ('STT_FILE', 'STT_SECTION'):
+      continue
+
+    overlay_symbols_lookup[name] = symbol['st_value']
 
 def resolve_symbol(symbol):
   # Returns address and overlay ID
-  if symbol in overlay_symbols_lookup:
-    return (overlay_symbols_lookup[symbol], OVERLAY_INDEX)
-  if symbol in rom_symbols_lookup:
-    return rom_symbols_lookup[symbol]
+  offset = overlay_symbols_lookup.get(symbol)
+  if offset is not None:
+    return (offset, OVERLAY_INDEX)
 
-  return None
+  return rom_symbols_lookup.get(symbol)
 
 def apply_overlay():
   assert OVERLAY_INDEX in overlays, "No overlay 36 found, apply the ExtraSpace patch first."
@@ -95,8 +89,7 @@ def apply_overlay():
   assert overlay.ramSize == 0x38F80, "Unexpected overlay RAM size"
   overlay_bytes = rom.files[overlay.fileID]
 
-  with open(overlay_bin_path, "rb") as f:
-    custom_code_bytes = f.read()
+  custom_code_bytes = Path(overlay_bin_path).read_bytes()
 
   # Combine the existing overlay bytes with the custom code
   padding = START_ADDRESS - overlay.ramAddress
@@ -113,73 +106,127 @@ def apply_overlay():
   rom.arm9OverlayTable = ndspy.code.saveOverlayTable(overlays)
 
 def apply_binary_patches():
-  overlay_bytes = { -1: (bytearray(rom.arm9), rom.arm9RamAddress) }
-  for index, overlay in overlays.items():
-    if index != OVERLAY_INDEX:
-      overlay_bytes[index] = (bytearray(rom.files[overlay.fileID]), overlay.ramAddress)
-
+  # Only the binaries that are actually patched are copied and written back
+  overlay_bytes = {}
+  assembler = keystone.Ks(keystone.KS_ARCH_ARM, keystone.KS_MODE_ARM)
   for file in glob.glob("patches/*.cotpatch"):
-    apply_binary_patch(file, overlay_bytes)
-
-  file, ram_address = overlay_bytes[-1]
-  rom.arm9 = bytes(file)
-  for index, overlay in overlays.items():
-    if index != OVERLAY_INDEX:
-      file, ram_address = overlay_bytes[index]
-      rom.files[overlay.fileID] = bytes(file)
+    apply_binary_patch(file, overlay_bytes, assembler)
+
+  for index, (file, ram_address) in overlay_bytes.items():
+    if index == -1:
+      rom.arm9 = bytes(file)
+    else:
+      rom.files[overlays[index].fileID] = bytes(file)
+
+def get_patch_target(overlay_bytes, overlay_index):
+  # Returns the mutable buffer and RAM address of a binary, loading it on first use
+  target = overlay_bytes.get(overlay_index)
+  if target is None:
+    if overlay_index == -1:
+      target = (bytearray(rom.arm9), rom.arm9RamAddress)
+    else:
+      assert overlay_index in overlays, f"Overlay {overlay_index} not found in the ROM"
+      overlay = overlays[overlay_index]
+      target = (bytearray(rom.files[overlay.fileID]), overlay.ramAddress)
+    overlay_bytes[overlay_index] = target
+  return target
 
 offset_regex = re.compile('(.+)\+(\d):', re.IGNORECASE)
 branch_regex = re.compile('^bl?(eq|ne|cs|hs|cc|lo|mi|pl|vs|vc|hi|ls|ge|lt|gt|le|al)?$', re.IGNORECASE)
-
-def apply_binary_patch(file_path, overlay_bytes):
+comment_regex = re.compile('//|#|;') # Matches the start of "//", "#" and ";" comments
+# Instructions that can take an address operand: branches, ADR and literal loads/stores
+position_dependent_regex = re.compile(r'^(b|adr|ld|st|pl)', re.IGNORECASE)
+
+def is_numeric_operand(operand):
+  return operand.isnumeric() or operand.startswith("0x")
+
+def write_patch_bytes(target, address, asm_bytes):
+  # Writes the assembled bytes at the given address and returns the address after them
+  overlay_file, ram_offset = target
+  start = address - ram_offset
+  end = start + len(asm_bytes)
+  assert 0 <= start and end <= len(overlay_file), f"Patch at {address:#x} is outside of the binary"
+  overlay_file[start:end] = asm_bytes
+  return end + ram_offset
+
+def flush_instructions(assembler, pending_lines, target, address):
+  # Assembles all pending instructions in one call at the address they are written to
+  if not pending_lines:
+    return address
+
+  asm_bytes, instruction_count = assembler.asm("\n".join(pending_lines), address)
+  pending_lines.clear()
+  return write_patch_bytes(target, address, asm_bytes)
+
+def apply_binary_patch(file_path, overlay_bytes, assembler):
   print("Applying binary patch: " + file_path)
-  assembler = keystone.Ks(keystone.KS_ARCH_ARM, keystone.KS_MODE_ARM)
+
+  offset_match = offset_regex.match
+  branch_match = branch_regex.match
+  comment_split = comment_regex.split
+  position_dependent_match = position_dependent_regex.match
 
   with open(file_path, 'r') as f:
-    current_offset = -1
+    current_offset = -1 # Address of the first pending instruction
     overlay_index = -1
+    target = None
+    pending_lines = []
     for line in f:
-      line = line.split("//")[0] # Remove "//" comments
-      line = line.split("#")[0] # Remove "#" comments
-      line = line.split(";")[0] # Remove ";" comments
-      line = line.strip()
+      line = comment_split(line, 1)[0].strip() # Remove comments
       if line == "":
         continue
 
-      match = offset_regex.match(line)
+      match = offset_match(line)
       if match:
         # Line in format: [symbol]+[hex offset]:
+        flush_instructions(assembler, pending_lines, target, current_offset)
         symbol, offset_str = match.groups()
         offset = int(offset_str, 16)
-        assert symbol in rom_symbols_lookup, f"No symbol '{symbol}' found"
-        symbol_offset, overlay_index = rom_symbols_lookup[symbol]
+        resolved = rom_symbols_lookup.get(symbol)
+        assert resolved, f"No symbol '{symbol}' found"
+        symbol_offset, overlay_index = resolved
         current_offset = symbol_offset + offset
+        target = get_patch_target(overlay_bytes, overlay_index)
       else:
         # Instruction
         assert current_offset != -1, "Symbol and offset must be specified before instructions"
 
+        # Numeric address operands, directives and "=" literals are relative to the line itself,
+        # so they are assembled on their own at address 0 like before
         split_line = line.split()
-        if branch_regex.match(split_line[0]):
+        standalone = line.startswith('.') or '=' in line
+        if branch_match(split_line[0]):
           assert len(split_line) >= 2, "Branch must have an operand"
 
-          if not split_line[1].isnumeric() and not split_line[1].startswith("0x"):
+          if is_numeric_operand(split_line[1]):
+            standalone = True
+          else:
             # The branch is not numeric, so it points to a symbol
             resolved = resolve_symbol(split_line[1])
             assert resolved, f"Failed to resolve symbol: '{split_line[1]}'"
 
             sym_offset, _ = resolved
             if sym_offset:
-              line = f"{split_line[0]} {hex(sym_offset - current_offset)}"
-
-        bytes, instruction_count = assembler.asm(line)
-        overlay_file, ram_offset = overlay_bytes[overlay_index]
-        for byte in bytes:
-          overlay_file[current_offset - ram_offset] = byte
-          current_offset += 1
-
-load_linkerscript_symbols()
-load_overlay_symbols()
-apply_overlay()
-apply_binary_patches()
+              # The batch is assembled at its real address, so keystone computes the relative offset
+              line = f"{split_line[0]} {sym_offset:#x}"
+        elif position_dependent_match(split_line[0]) and '[' not in line and is_numeric_operand(split_line[-1]):
+          standalone = True
+
+        if standalone:
+          current_offset = flush_instructions(assembler, pending_lines, target, current_offset)
+          asm_bytes, instruction_count = assembler.asm(line)
+          current_offset = write_patch_bytes(target, current_offset, asm_bytes)
+        else:
+          pending_lines.append(line)
+
+    flush_instructions(assembler, pending_lines, target, current_offset)
+
+# Map the overlay ELF once for the symbol loader
+with open(overlay_elf_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as overlay_elf_map:
+  overlay_elf = ELFFile(overlay_elf_map)
+  load_linkerscript_symbols()
+  load_overlay_symbols(overlay_elf)
+  apply_overlay()
+  apply_binary_patches()
 
 rom.saveToFile(rom_out_path)